@@ -0,0 +1,40 @@
+import numpy as np
+
+from pyglet.gl import *  # NOQA
+
+
+# GL objects and state already issued by the scene and mesh widgets, used to
+# skip redundant driver calls.  Nothing else in the app touches the material,
+# light, blend and depth parameters, so once set they persist in the context.
+gl_state_cache = {}
+
+# capabilities enabled while drawing a scene or a mesh, and restored afterwards
+CAPABILITIES = (
+    GL_DEPTH_TEST,
+    GL_CULL_FACE,
+    GL_COLOR_MATERIAL,
+    GL_BLEND,
+    GL_LINE_SMOOTH,
+    GL_LIGHTING,
+    GL_LIGHT0,
+)
+
+MATERIAL_AMBIENT = (GLfloat * 3)(0.192250, 0.192250, 0.192250)
+MATERIAL_DIFFUSE = (GLfloat * 3)(0.507540, 0.507540, 0.507540)
+MATERIAL_SPECULAR = (GLfloat * 3)(0.5082730, .5082730, .5082730)
+
+LIGHT_AMBIENT = (GLfloat * 4)(0.5, 0.5, 0.5, 1.0)
+LIGHT_DIFFUSE = (GLfloat * 4)(1.0, 1.0, 1.0, 1.0)
+LIGHT_SPECULAR = (GLfloat * 4)(1.0, 1.0, 1.0, 1.0)
+LIGHT_POSITION = (GLfloat * 4)(0.0, 0.0, 0.0, 1.0)
+
+
+def perspective_matrix(fovy, aspect, near, far):
+    """Return the projection matrix gluPerspective would build."""
+    f = 1.0 / np.tan(np.radians(fovy) / 2.0)
+    return np.array([
+        [f / aspect, 0, 0, 0],
+        [0, f, 0, 0],
+        [0, 0, (far + near) / (near - far), 2 * far * near / (near - far)],
+        [0, 0, -1, 0],
+    ])
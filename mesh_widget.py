@@ -1,3 +1,5 @@
+import ctypes
+
 import glooey
 import numpy as np
 import pyglet
@@ -5,44 +7,126 @@ import trimesh
 
 from pyglet.gl import *  # NOQA
 
+from gl_state import (
+    CAPABILITIES,
+    LIGHT_AMBIENT,
+    LIGHT_DIFFUSE,
+    LIGHT_POSITION,
+    LIGHT_SPECULAR,
+    MATERIAL_AMBIENT,
+    MATERIAL_DIFFUSE,
+    MATERIAL_SPECULAR,
+    gl_state_cache,
+    perspective_matrix,
+)
+
+
+def copy_matrix_to_gl(matrix, buffer):
+    """Copy a (4, 4) matrix into a GLfloat * 16 buffer, column-major."""
+    matrix = np.ascontiguousarray(np.transpose(matrix), dtype=np.float32)
+    ctypes.memmove(buffer, matrix.ctypes.data, matrix.nbytes)
+
+
+def quaternion_to_rotation(quaternion):
+    """Return the (3, 3) float32 rotation of a (w, x, y, z) quaternion.
+
+    Same as the rotation block of trimesh.transformations.quaternion_matrix,
+    but written out in scalar arithmetic, which is cheaper than numpy calls
+    for a single quaternion.
+    """
+    w, x, y, z = [float(q) for q in quaternion]
+    n = w * w + x * x + y * y + z * z
+    if n < np.finfo(float).eps * 4.0:
+        return np.eye(3, dtype=np.float32)
+    s = 2.0 / n
+    xx, yy, zz = s * x * x, s * y * y, s * z * z
+    xy, xz, yz = s * x * y, s * x * z, s * y * z
+    wx, wy, wz = s * w * x, s * w * y, s * w * z
+    return np.array([
+        [1.0 - yy - zz, xy - wz, xz + wy],
+        [xy + wz, 1.0 - xx - zz, yz - wx],
+        [xz - wy, yz + wx, 1.0 - xx - yy],
+    ], dtype=np.float32)
+
+
+def arcball_rotation(ball):
+    """Return the (3, 3) float32 rotation of a trimesh Arcball.
+
+    Arcball only exposes its rotation through matrix(), which builds a
+    (4, 4) float64 matrix.  Its current quaternion is kept in the private
+    ``_qnow``, so convert that directly when it exists, and fall back to
+    matrix() for Arcball versions without it.
+    """
+    quaternion = getattr(ball, '_qnow', None)
+    if quaternion is None:
+        return ball.matrix()[:3, :3].astype(np.float32)
+    return quaternion_to_rotation(quaternion)
+
 
 class SceneGroup(pyglet.graphics.Group):
 
+    __slots__ = (
+        '_rect',
+        '_scissor',
+        '_mode',
+        '_viewport',
+        '_projection',
+    )
+
     def __init__(self, rect, parent=None):
         super().__init__(parent)
+        self._projection = (GLfloat * 16)()
         self.rect = rect
 
+    @property
+    def rect(self):
+        return self._rect
+
+    @rect.setter
+    def rect(self, rect):
+        # converted to ints, and the projection built, here as the rect only
+        # changes on resize
+        self._rect = rect
+        self._scissor = (
+            int(rect.left),
+            int(rect.bottom),
+            int(rect.width),
+            int(rect.height),
+        )
+        width, height = self._scissor[2:]
+        aspect = width / height if height else 1.0
+        copy_matrix_to_gl(
+            perspective_matrix(60, aspect, 0.01, 1000.0), self._projection
+        )
+
     def set_state(self):
         glPushAttrib(GL_ENABLE_BIT)
         glEnable(GL_SCISSOR_TEST)
-        glScissor(
-            int(self.rect.left),
-            int(self.rect.bottom),
-            int(self.rect.width),
-            int(self.rect.height),
-        )
+        glScissor(*self._scissor)
 
         self._mode = (GLint)()
         glGetIntegerv(GL_MATRIX_MODE, self._mode)
         self._viewport = (GLint * 4)()
         glGetIntegerv(GL_VIEWPORT, self._viewport)
 
-        left, bottom = int(self.rect.left), int(self.rect.bottom)
-        width, height = int(self.rect.width), int(self.rect.height)
-        glViewport(left, bottom, width, height)
+        glViewport(*self._scissor)
         glMatrixMode(GL_PROJECTION)
         glPushMatrix()
-        glLoadIdentity()
-        gluPerspective(60, width / height, 0.01, 1000.0)
+        glLoadMatrixf(self._projection)
         glMatrixMode(GL_MODELVIEW)
 
         glClearColor(*[.99, .99, .99, 1.0])
 
-        self._enable_depth()
-        self._enable_color_material()
-        self._enable_blending()
-        self._enable_smooth_lines()
-        self._enable_lighting()
+        if gl_state_cache.get('initialized'):
+            for cap in CAPABILITIES:
+                glEnable(cap)
+        else:
+            self._enable_depth()
+            self._enable_color_material()
+            self._enable_blending()
+            self._enable_smooth_lines()
+            self._enable_lighting()
+            gl_state_cache['initialized'] = True
         self._clear_buffers()
 
     def unset_state(self):
@@ -69,16 +153,14 @@ class SceneGroup(pyglet.graphics.Group):
         glClearDepth(1.0)
 
     def _enable_color_material(self):
-        from trimesh.rendering import vector_to_gl as v
-
         glEnable(GL_COLOR_MATERIAL)
 
         glColorMaterial(GL_FRONT_AND_BACK, GL_AMBIENT_AND_DIFFUSE)
         glShadeModel(GL_SMOOTH)
 
-        glMaterialfv(GL_FRONT, GL_AMBIENT, v(0.192250, 0.192250, 0.192250))
-        glMaterialfv(GL_FRONT, GL_DIFFUSE, v(0.507540, 0.507540, 0.507540))
-        glMaterialfv(GL_FRONT, GL_SPECULAR, v(0.5082730, .5082730, .5082730))
+        glMaterialfv(GL_FRONT, GL_AMBIENT, MATERIAL_AMBIENT)
+        glMaterialfv(GL_FRONT, GL_DIFFUSE, MATERIAL_DIFFUSE)
+        glMaterialfv(GL_FRONT, GL_SPECULAR, MATERIAL_SPECULAR)
         glMaterialf(GL_FRONT, GL_SHININESS, 0.4 * 128.0)
 
     def _enable_blending(self):
@@ -93,15 +175,13 @@ class SceneGroup(pyglet.graphics.Group):
         glPointSize(4)
 
     def _enable_lighting(self):
-        from trimesh.rendering import vector_to_gl as v
-
         glEnable(GL_LIGHTING)
         glEnable(GL_LIGHT0)
 
-        glLightfv(GL_LIGHT0, GL_AMBIENT, v(0.5, 0.5, 0.5, 1.0))
-        glLightfv(GL_LIGHT0, GL_DIFFUSE, v(1.0, 1.0, 1.0, 1.0))
-        glLightfv(GL_LIGHT0, GL_SPECULAR, v(1.0, 1.0, 1.0, 1.0))
-        glLightfv(GL_LIGHT0, GL_POSITION, v(0.0, 0.0, 0.0, 1.0))
+        glLightfv(GL_LIGHT0, GL_AMBIENT, LIGHT_AMBIENT)
+        glLightfv(GL_LIGHT0, GL_DIFFUSE, LIGHT_DIFFUSE)
+        glLightfv(GL_LIGHT0, GL_SPECULAR, LIGHT_SPECULAR)
+        glLightfv(GL_LIGHT0, GL_POSITION, LIGHT_POSITION)
 
     def _clear_buffers(self):
         glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
@@ -109,56 +189,186 @@ class SceneGroup(pyglet.graphics.Group):
 
 class MeshGroup(pyglet.graphics.Group):
 
+    __slots__ = ('_transform', '_view_transform', '_modelview_gl')
+
     def __init__(self, transform=None, view_transform=None, parent=None):
         super().__init__(parent)
+        # GL copy of view_transform @ transform, written when either is
+        # assigned so set_state only has to load it
+        self._modelview_gl = (GLfloat * 16)()
+
         if transform is None:
             transform = np.eye(4)
-        self.transform = transform
+        self._transform = np.asarray(transform, dtype=np.float32)
         if view_transform is None:
             view_transform = np.eye(4)
-        self.view_transform = view_transform
+        self._view_transform = np.asarray(view_transform, dtype=np.float32)
+        self._update_modelview()
+
+    @property
+    def transform(self):
+        return self._transform
+
+    @transform.setter
+    def transform(self, transform):
+        self._transform = np.asarray(transform, dtype=np.float32)
+        self._update_modelview()
+
+    @property
+    def view_transform(self):
+        return self._view_transform
+
+    @view_transform.setter
+    def view_transform(self, view_transform):
+        self._view_transform = np.asarray(view_transform, dtype=np.float32)
+        self._update_modelview()
+
+    def _update_modelview(self):
+        copy_matrix_to_gl(
+            np.dot(self._view_transform, self._transform), self._modelview_gl
+        )
 
     def set_state(self):
-        from trimesh.rendering import matrix_to_gl
-
         glPushMatrix()
-
-        glLoadIdentity()
-        glMultMatrixf(matrix_to_gl(self.view_transform))
-        glMultMatrixf(matrix_to_gl(self.transform))
+        glLoadMatrixf(self._modelview_gl)
 
     def unset_state(self):
         glPopMatrix()
 
 
+class View:
+
+    # Arcball view state of a MeshWidget.  The view transform is cached and
+    # only rebuilt after something that changes it, so events that don't
+    # move the view (e.g. mouse presses) don't recompute it.
+
+    __slots__ = (
+        '_translation',
+        '_center',
+        '_scale',
+        'ball',
+        '_rotation',
+        '_dirty',
+        '_matrix',
+    )
+
+    def __init__(self, center, scale):
+        from trimesh.transformations import Arcball
+
+        # float32 like the GL matrices they end up in, so building the view
+        # transform never converts between float widths
+        self._translation = np.zeros(3, dtype=np.float32)
+        self._center = np.asarray(center, dtype=np.float32)
+        self._scale = float(scale)
+        self.ball = Arcball()
+        self._rotation = None  # cached rotation block of ball.matrix()
+        self._dirty = True
+        # rewritten in place by matrix()
+        self._matrix = np.eye(4, dtype=np.float32)
+
+    @property
+    def translation(self):
+        return self._translation
+
+    @translation.setter
+    def translation(self, translation):
+        self._translation = np.asarray(translation, dtype=np.float32)
+        self._dirty = True
+
+    @property
+    def center(self):
+        return self._center
+
+    @center.setter
+    def center(self, center):
+        self._center = np.asarray(center, dtype=np.float32)
+        self._dirty = True
+
+    @property
+    def scale(self):
+        return self._scale
+
+    @scale.setter
+    def scale(self, scale):
+        self._scale = float(scale)
+        self._dirty = True
+
+    def down(self, point):
+        # starting a drag doesn't rotate the ball, so the matrix stays valid
+        self.ball.down(point)
+
+    def drag(self, point):
+        self.ball.drag(point)
+        self._rotation = None
+        self._dirty = True
+
+    def pan(self, delta):
+        self._translation[:2] += delta
+        self._dirty = True
+
+    def rotation(self):
+        # only dragging turns the ball, so panning reuses the last rotation
+        # instead of converting the ball's quaternion again
+        if self._rotation is None:
+            self._rotation = arcball_rotation(self.ball)
+        return self._rotation
+
+    @property
+    def dirty(self):
+        # whether matrix() has to rebuild the transform
+        return self._dirty
+
+    def matrix(self):
+        if self._dirty:
+            view_to_transform(self, out=self._matrix)
+            self._dirty = False
+        return self._matrix
+
+
 class MeshWidget(glooey.Widget):
 
     # I suppose this should take a scene object rather than a mesh, but I
     # couldn't really figure out how to make a scene object.
 
+    __slots__ = (
+        'mesh',
+        'transform',
+        'vertex_list',
+        'scene_group',
+        'mesh_group',
+        'view',
+    )
+
     def __init__(self, mesh, transform):
         super().__init__()
         self.mesh = mesh
         self.transform = transform
         self.vertex_list = None
+        self.scene_group = None
         self.mesh_group = None
 
-        from trimesh.transformations import Arcball
-
-        self.view = {'translation': np.zeros(3),
-                     'center': self.mesh.centroid,
-                     'scale': self.mesh.scale,
-                     'ball': Arcball()}
+        self.view = View(center=self.mesh.centroid, scale=self.mesh.scale)
 
     def do_claim(self):
         return 0, 0
 
+    def do_resize(self):
+        # the groups read the rect when drawn, so a resize only needs to
+        # hand them the new one rather than rebuilding them
+        if self.scene_group is not None:
+            self.scene_group.rect = self.rect
+
     def do_regroup(self):
         if self.vertex_list is not None:
+            if self.scene_group.parent == self.group:
+                return
+            # pyglet can't reparent a group in place, so only a new parent
+            # group needs new groups and a migration
+            self.scene_group = SceneGroup(rect=self.rect, parent=self.group)
             self.mesh_group = MeshGroup(
-                transform=transform,
-                view_transform=view_to_transform(self.view),
-                parent=SceneGroup(rect=self.rect, parent=self.group),
+                transform=self.transform,
+                view_transform=self.view.matrix(),
+                parent=self.scene_group,
             )
             self.batch.migrate(
                 self.vertex_list,
@@ -173,10 +383,11 @@ class MeshWidget(glooey.Widget):
         # Because the vertex list can't change, we don't need to do anything if
         # the vertex list is already set.
         if self.vertex_list is None:
+            self.scene_group = SceneGroup(rect=self.rect, parent=self.group)
             self.mesh_group = MeshGroup(
                 transform=self.transform,
-                view_transform=view_to_transform(self.view),
-                parent=SceneGroup(rect=self.rect, parent=self.group),
+                view_transform=self.view.matrix(),
+                parent=self.scene_group,
             )
             args = mesh_to_vertexlist(self.mesh, group=self.mesh_group)
             self.vertex_list = self.batch.add_indexed(*args)
@@ -187,40 +398,55 @@ class MeshWidget(glooey.Widget):
             self.vertex_list = None
 
     def on_mouse_press(self, x, y, buttons, modifiers):
-        self.view['ball'].down([x, -y])
-        if self.mesh_group:
-            self.mesh_group.view_transform = view_to_transform(self.view)
-        self._draw()
+        self.view.down((x, -y))
+        self._update_view()
 
     def on_mouse_drag(self, x, y, dx, dy, buttons, modifiers):
+        if dx == 0 and dy == 0:
+            return
+
         # detect crossing edge between widgets
         x_prev = x - dx
         y_prev = y - dy
-        left, bottom = self.rect.left, self.rect.bottom
-        width, height = self.rect.width, self.rect.height
-        if not (left <= x_prev <= left + width) or \
-                not (bottom <= y_prev <= bottom + height):
-            self.view['ball'].down([x, y])
+        rect = self.rect
+        left, bottom = rect.left, rect.bottom
+        right, top = left + rect.width, bottom + rect.height
+        # bitwise or evaluates all four tests without short-circuit branches
+        if (x_prev < left) | (x_prev > right) | \
+                (y_prev < bottom) | (y_prev > top):
+            self.view.down((x, -y))
 
         # left mouse button, with control key down (pan)
         if (buttons == pyglet.window.mouse.LEFT) and \
                 (modifiers & pyglet.window.key.MOD_CTRL):
             delta = [dx / self.rect.width, dy / self.rect.height]
-            self.view['translation'][:2] += delta
+            self.view.pan(delta)
         # left mouse button, no modifier keys pressed (rotate)
         elif (buttons == pyglet.window.mouse.LEFT):
-            self.view['ball'].drag([x, -y])
+            self.view.drag((x, -y))
+        self._update_view()
+
+    def _update_view(self):
+        # only redraw if the view actually changed, e.g. pressing the mouse
+        # doesn't move it
+        if not self.view.dirty:
+            return
         if self.mesh_group:
-            self.mesh_group.view_transform = view_to_transform(self.view)
+            self.mesh_group.view_transform = self.view.matrix()
         self._draw()
 
 
-def view_to_transform(view):
-    transform = view['ball'].matrix()
-    transform[:3, 3] = view['center']
-    transform[:3, 3] -= np.dot(transform[:3, :3], view['center'])
-    transform[:3, 3] += view['translation'] * view['scale']
-    return transform
+def view_to_transform(view, out=None):
+    # rotate about the center, then translate: a single write of the
+    # translation column instead of three in-place updates
+    if out is None:
+        out = np.eye(4, dtype=np.float32)
+    rotation = out[:3, :3]
+    rotation[...] = view.rotation()
+    center = view.center
+    out[:3, 3] = center - np.dot(rotation, center) + \
+        view.translation * view.scale
+    return out
 
 
 def main():
@@ -1,81 +1,507 @@
+import collections
+import ctypes
+import io
+
 import glooey
 import numpy as np
 import pyglet
+import pyglet.image.atlas
 from pyrender.trackball import Trackball
 import trimesh
 import trimesh.transformations as tf
 
 from pyglet.gl import *  # NOQA
 
+from gl_state import (
+    CAPABILITIES,
+    LIGHT_AMBIENT,
+    LIGHT_DIFFUSE,
+    LIGHT_POSITION,
+    LIGHT_SPECULAR,
+    MATERIAL_AMBIENT,
+    MATERIAL_DIFFUSE,
+    MATERIAL_SPECULAR,
+    gl_state_cache,
+    perspective_matrix,
+)
+
+
+# capabilities enabled while drawing a scene, and restored afterwards
+_CAPABILITIES = CAPABILITIES + (GL_NORMALIZE,)
+
+# Capabilities that parent groups of these types leave enabled for their
+# children.  A scene drawn below one of them must leave those enabled too.
+# Add other group types here if a SceneWidget is placed under them.
+_PARENT_GROUP_CAPABILITIES = [
+    (glooey.drawing.ScissorGroup, (GL_SCISSOR_TEST,)),
+]
+
+# numpy types of the pyglet vertex format type codes
+_GL_DTYPES = {
+    'b': np.int8,
+    'B': np.uint8,
+    's': np.int16,
+    'S': np.uint16,
+    'i': np.int32,
+    'I': np.uint32,
+    'f': np.float32,
+    'd': np.float64,
+}
+
+
+def matrix_to_gl(matrix):
+    """Convert a (4, 4) matrix to a column-major GLfloat array.
+
+    Same as trimesh.rendering.matrix_to_gl, but copies the buffer in one go
+    instead of passing every element through the ctypes constructor.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    return (GLfloat * 16).from_buffer_copy(matrix.tobytes(order='F'))
+
+
+def _forsyth_order(faces, vertex_count, cache_size=32):
+    # Tom Forsyth's "Linear-Speed Vertex Cache Optimisation": greedily emit
+    # the triangle whose vertices score highest, where a vertex scores for
+    # being recently used in a simulated LRU cache and for having few
+    # remaining triangles.
+    def score(vertex, position):
+        remaining = len(vertex_faces[vertex])
+        if remaining == 0:
+            return -1.0
+        if position < 0:
+            value = 0.0
+        elif position < 3:
+            value = 0.75
+        else:
+            value = (1.0 - (position - 3) / (cache_size - 3)) ** 1.5
+        return value + 2.0 * remaining ** -0.5
+
+    faces = faces.tolist()
+    vertex_faces = [[] for _ in range(vertex_count)]
+    for f, face in enumerate(faces):
+        for vertex in face:
+            vertex_faces[vertex].append(f)
+    vertex_scores = [score(v, -1) for v in range(vertex_count)]
+
+    emitted = [False] * len(faces)
+    order = []
+    cache = []
+    next_face = 0  # fallback when no cached vertex has triangles left
+    best = -1
+    while len(order) < len(faces):
+        if best < 0:
+            while emitted[next_face]:
+                next_face += 1
+            best = next_face
+        order.append(best)
+        emitted[best] = True
+
+        face = faces[best]
+        for vertex in face:
+            vertex_faces[vertex].remove(best)
+        cache = face + [v for v in cache if v not in face]
+        touched, cache = cache, cache[:cache_size]
+        for position, vertex in enumerate(touched):
+            if position >= cache_size:
+                position = -1
+            vertex_scores[vertex] = score(vertex, position)
+
+        best, best_score = -1, -1.0
+        for vertex in cache:
+            for f in vertex_faces[vertex]:
+                a, b, c = faces[f]
+                face_score = \
+                    vertex_scores[a] + vertex_scores[b] + vertex_scores[c]
+                if face_score > best_score:
+                    best, best_score = f, face_score
+    return np.array(order, dtype=np.int64)
+
+
+def optimize_vertexlist(args, max_faces=10000):
+    """Reorder mesh_to_vertexlist args for the GPU vertex caches.
+
+    Triangles are sorted so consecutive ones share vertices still in the
+    post-transform cache, then vertices are renumbered in order of first use
+    so fetches walk the vertex buffer sequentially.
+
+    The triangle sort runs in pure Python, so meshes with more than
+    ``max_faces`` faces are returned unchanged rather than stalling the
+    first draw.  Pass None to optimize every mesh.
+    """
+    count, mode, group, indices, *attributes = args
+    faces = np.asarray(indices, dtype=np.int64).reshape(-1, 3)
+    if len(faces) == 0:
+        return args
+    if max_faces is not None and len(faces) > max_faces:
+        return args
+    faces = faces[_forsyth_order(faces, count)]
+
+    used, first = np.unique(faces.reshape(-1), return_index=True)
+    unused = np.setdiff1d(np.arange(count), used)
+    order = np.concatenate([used[np.argsort(first)], unused])
+    remap = np.empty(count, dtype=np.int64)
+    remap[order] = np.arange(count)
+    faces = remap[faces]
+
+    data = []
+    for format, values in attributes:
+        values = np.asarray(values).reshape(count, -1)[order]
+        data.append((format, values.reshape(-1).tolist()))
+    return (count, mode, group, faces.reshape(-1).tolist()) + tuple(data)
+
+
+def frustum_planes(matrix):
+    """Return the (6, 4) planes of the view frustum of a world to clip matrix.
+
+    A point ``p`` is inside when ``np.dot(planes[:, :3], p) + planes[:, 3]``
+    is non-negative for every plane (Gribb & Hartmann).
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    return np.array([
+        matrix[3] + matrix[0],
+        matrix[3] - matrix[0],
+        matrix[3] + matrix[1],
+        matrix[3] - matrix[1],
+        matrix[3] + matrix[2],
+        matrix[3] - matrix[2],
+    ])
+
+
+def bounds_in_frustum(bounds, planes):
+    """Return whether each of (n, 2, 3) bounds intersects the frustum planes.
+
+    Conservative: boxes near a frustum corner may be reported as visible.
+    """
+    bounds = np.asarray(bounds, dtype=np.float64)
+    center = bounds.mean(axis=1)
+    extent = (bounds[:, 1] - bounds[:, 0]) / 2.0
+    # distance of the box center to each plane, and the projected radius of
+    # the box onto each plane normal
+    distance = np.dot(center, planes[:, :3].T) + planes[:, 3]
+    radius = np.dot(extent, np.abs(planes[:, :3]).T)
+    return (distance + radius >= 0).all(axis=1)
+
+
+def transform_vertexlist(args, transform):
+    """Apply a (4, 4) transform to vertexlist positions and normals.
+
+    Positions and normals are each transformed with a single matrix product,
+    normals by the inverse transpose so they stay perpendicular to the
+    surface under non-uniform scale.
+    """
+    transform = np.asarray(transform, dtype=np.float64)
+    rotation = transform[:3, :3]
+
+    count, mode, group, indices, *attributes = args
+    data = []
+    for format, values in attributes:
+        if format.startswith('v3f'):
+            values = np.asarray(values, dtype=np.float64).reshape(-1, 3)
+            values = np.dot(values, rotation.T) + transform[:3, 3]
+        elif format.startswith('n3f'):
+            values = np.asarray(values, dtype=np.float64).reshape(-1, 3)
+            # row vectors, so n @ inv(R) is inv(R).T @ n for each normal
+            values = np.dot(values, np.linalg.inv(rotation))
+            norms = np.linalg.norm(values, axis=1, keepdims=True)
+            values /= np.where(norms == 0, 1, norms)
+        data.append((format, values))
+
+    if np.linalg.det(rotation) < 0:
+        # reflections flip the winding, which would get back faces culled
+        indices = np.asarray(indices).reshape(-1, 3)[:, ::-1].reshape(-1)
+    return (count, mode, group, indices) + tuple(data)
+
+
+def vertexlist_bounds(vertexlists):
+    """Return the (2, 3) bounds of the positions of mesh_to_vertexlist args."""
+    vertices = [
+        np.asarray(values, dtype=np.float64).reshape(-1, 3)
+        for args in vertexlists
+        for format, values in args[4:]
+        if format.startswith('v')
+    ]
+    vertices = np.concatenate(vertices)
+    return np.array([vertices.min(axis=0), vertices.max(axis=0)])
+
+
+def bounds_to_quantization(bounds):
+    """Return the (center, scale) mapping ``bounds`` onto signed shorts.
+
+    The scale is uniform so normals stay perpendicular after dequantization.
+    """
+    bounds = np.asarray(bounds, dtype=np.float64)
+    center = bounds.mean(axis=0)
+    extent = (bounds[1] - bounds[0]).max() / 2.0
+    if extent == 0:
+        extent = 1.0
+    return tuple(center), extent / 32767.0
+
+
+def quantize_vertexlist(args, quantization):
+    """Store vertexlist positions as shorts and normals as bytes.
+
+    Positions become ``(vertex - center) / scale`` for the (center, scale)
+    ``quantization``, and are restored on the GPU by translating by center
+    and scaling by scale.
+    """
+    center, scale = quantization
+    count, mode, group, indices, *attributes = args
+    data = []
+    for format, values in attributes:
+        name, slash, usage = format.partition('/')
+        if name == 'v3f':
+            values = np.asarray(values, dtype=np.float64).reshape(-1, 3)
+            values = np.round((values - center) / scale)
+            name = 'v3s'
+        elif name == 'n3f':
+            values = np.round(np.asarray(values, dtype=np.float64) * 127)
+            name = 'n3b'
+        else:
+            data.append((format, values))
+            continue
+        values = values.astype(np.int64).reshape(-1).tolist()
+        data.append((name + slash + usage, values))
+    return (count, mode, group, indices) + tuple(data)
+
+
+def pack_vertexlist(args):
+    """Convert mesh_to_vertexlist args to GL-ready buffers.
+
+    Returns
+    -------
+    vertexlist : tuple
+      (vertex_count, indices, attributes) where indices is an int ndarray
+      and attributes a list of (format, bytes), the bytes holding the values
+      in the C type named by the format.
+    """
+    count, _, _, indices, *attributes = args
+    data = []
+    for format, values in attributes:
+        dtype = _GL_DTYPES[format.partition('/')[0][-1]]
+        data.append((format, np.asarray(values).astype(dtype).tobytes()))
+    return count, np.asarray(indices, dtype=np.int64), data
+
+
+def atlas_tex_coords(vertexlist, region):
+    """Map the texture coords of a packed vertexlist into a texture region.
+
+    Texture coords must lie within [0, 1], as wrapping would sample the
+    neighbouring images of the atlas.
+    """
+    tex_coords = region.tex_coords
+    offset = np.array(tex_coords[0:2], dtype=np.float32)
+    scale = np.array(tex_coords[6:8], dtype=np.float32) - offset
+
+    count, indices, attributes = vertexlist
+    data = []
+    for format, values in attributes:
+        if format.startswith('t2f'):
+            uv = np.frombuffer(values, dtype=np.float32).reshape(-1, 2)
+            values = (uv * scale + offset).astype(np.float32).tobytes()
+        data.append((format, values))
+    return count, indices, data
+
+
+def merge_vertexlists(vertexlists):
+    """Merge packed vertex lists sharing a vertex format.
+
+    Returns the merged (vertex_count, indices, attributes) and the
+    (index_offset, index_count) of each input within it.
+    """
+    indices = []
+    ranges = []
+    offset = 0
+    index_offset = 0
+    for count, faces, _ in vertexlists:
+        indices.append(faces + offset)
+        ranges.append((index_offset, len(faces)))
+        offset += count
+        index_offset += len(faces)
+
+    data = []
+    for i, (format, _) in enumerate(vertexlists[0][2]):
+        # The scene's vertex data never changes after upload, so always ask
+        # pyglet for GL_STATIC_DRAW buffers whatever trimesh requested.
+        format = format.partition('/')[0] + '/static'
+        data.append((format, b''.join(v[2][i][1] for v in vertexlists)))
+    return (offset, np.concatenate(indices), data), ranges
+
 
 class SceneGroup(pyglet.graphics.Group):
 
+    # The projection and the whole camera * view * model chain are composed
+    # on the CPU and loaded with a single glLoadMatrixf each, so drawing
+    # doesn't go through glLoadIdentity/gluPerspective/glMultMatrixf.
+
+    # set_state reads these every frame, so keep them in slots rather than
+    # the instance dict
+    __slots__ = (
+        '_rect',
+        '_scissor',
+        'camera_fovy',
+        '_camera_transform',
+        '_view_transform',
+        '_model_transform',
+        '_modelview_gl',
+        '_pixel_per_point',
+        'viewport',
+        '_projection',
+        '_projection_gl',
+        '_scissor_parent',
+        '_disabled_capabilities',
+    )
+
+    z_near = 0.01
+    z_far = 1000.0
+
     def __init__(
         self,
         rect,
         camera_fovy=60,
         camera_transform=None,
         view_transform=None,
+        model_transform=None,
         parent=None,
         pixel_per_point=(1, 1),
+        viewport=None,
     ):
         super().__init__(parent)
-        self.rect = rect
-
         self.camera_fovy = camera_fovy
 
         # transform from world coords to camera coords
         if camera_transform is None:
             camera_transform = np.eye(4)
-        self.camera_transform = camera_transform
+        self._camera_transform = camera_transform
 
         # transform from world coords to view coords
         if view_transform is None:
             view_transform = np.eye(4)
-        self.view_transform = view_transform
+        self._view_transform = view_transform
+
+        # transform from vertex coords to world coords
+        if model_transform is None:
+            model_transform = np.eye(4)
+        self._model_transform = model_transform
+
+        self._update_modelview()
 
         self._pixel_per_point = pixel_per_point
 
-    def set_state(self):
-        left = int(self.rect.left)
-        bottom = int(self.rect.bottom)
-        width = int(self.rect.width)
-        height = int(self.rect.height)
+        # viewport of the window to restore after drawing, or None to leave
+        # the viewport as the scene set it
+        self.viewport = viewport
+
+        # Instead of saving the enables with glPushAttrib(GL_ENABLE_BIT) on
+        # every frame, the ones set by the parent chain are worked out once
+        # here, as the chain is fixed.  Those are restored after drawing and
+        # the rest disabled.  The innermost glooey ScissorGroup, e.g. of a
+        # ScrollBox, also needs its scissor box back.
+        self._scissor_parent = None
+        inherited = set()
+        group = parent
+        while group is not None:
+            for group_type, capabilities in _PARENT_GROUP_CAPABILITIES:
+                if isinstance(group, group_type):
+                    inherited.update(capabilities)
+            if self._scissor_parent is None and \
+                    isinstance(group, glooey.drawing.ScissorGroup):
+                self._scissor_parent = group
+            group = group.parent
+        self._disabled_capabilities = tuple(
+            cap for cap in _CAPABILITIES + (GL_SCISSOR_TEST,)
+            if cap not in inherited
+        )
 
-        left = int(self._pixel_per_point[0] * left)
-        bottom = int(self._pixel_per_point[1] * bottom)
-        width = int(self._pixel_per_point[0] * width)
-        height = int(self._pixel_per_point[1] * height)
+        self.rect = rect
 
-        glPushAttrib(GL_ENABLE_BIT)
-        glEnable(GL_SCISSOR_TEST)
-        glScissor(left, bottom, width, height)
+    @property
+    def rect(self):
+        return self._rect
+
+    @rect.setter
+    def rect(self, rect):
+        # The rect only changes on layout, so the viewport and projection are
+        # worked out here instead of on every frame in set_state.
+        self._rect = rect
+        left = int(self._pixel_per_point[0] * int(rect.left))
+        bottom = int(self._pixel_per_point[1] * int(rect.bottom))
+        width = int(self._pixel_per_point[0] * int(rect.width))
+        height = int(self._pixel_per_point[1] * int(rect.height))
+        self._scissor = (left, bottom, width, height)
+
+        aspect = width / height if height else 1.0
+        self._projection = perspective_matrix(
+            self.camera_fovy, aspect, self.z_near, self.z_far
+        )
+        self._projection_gl = matrix_to_gl(self._projection)
 
-        self._mode = (GLint)()
-        glGetIntegerv(GL_MATRIX_MODE, self._mode)
-        self._viewport = (GLint * 4)()
-        glGetIntegerv(GL_VIEWPORT, self._viewport)
+    @property
+    def pixel_per_point(self):
+        return self._pixel_per_point
+
+    @pixel_per_point.setter
+    def pixel_per_point(self, pixel_per_point):
+        self._pixel_per_point = pixel_per_point
+        self.rect = self._rect
+
+    @property
+    def projection_transform(self):
+        return self._projection
+
+    @property
+    def camera_transform(self):
+        return self._camera_transform
+
+    @camera_transform.setter
+    def camera_transform(self, camera_transform):
+        self._camera_transform = camera_transform
+        self._update_modelview()
+
+    @property
+    def view_transform(self):
+        return self._view_transform
+
+    @view_transform.setter
+    def view_transform(self, view_transform):
+        self._view_transform = view_transform
+        self._update_modelview()
 
-        glViewport(left, bottom, width, height)
+    @property
+    def model_transform(self):
+        return self._model_transform
+
+    @model_transform.setter
+    def model_transform(self, model_transform):
+        self._model_transform = model_transform
+        self._update_modelview()
+
+    def _update_modelview(self):
+        # converted once here rather than on every frame in set_state
+        self._modelview_gl = matrix_to_gl(
+            self._camera_transform @ self._view_transform @
+            self._model_transform
+        )
+
+    def set_state(self):
+        glEnable(GL_SCISSOR_TEST)
+        glScissor(*self._scissor)
+
+        glViewport(*self._scissor)
         glMatrixMode(GL_PROJECTION)
         glPushMatrix()
-        glLoadIdentity()
-        gluPerspective(self.camera_fovy, width / height, 0.01, 1000.0)
+        glLoadMatrixf(self._projection_gl)
         glMatrixMode(GL_MODELVIEW)
 
-        glClearColor(*[.99, .99, .99, 1.0])
-
-        self._enable_depth()
-        self._enable_color_material()
-        self._enable_blending()
-        self._enable_smooth_lines()
-        self._enable_lighting()
+        if 'state_list' not in gl_state_cache:
+            gl_state_cache['state_list'] = self._compile_state_list()
+        glCallList(gl_state_cache['state_list'])
         self._clear_buffers()
 
+        # textures may have been rebound by groups outside of this scene
+        gl_state_cache['texture'] = None
+
         glPushMatrix()
-        glLoadIdentity()
-        glMultMatrixf(trimesh.rendering.matrix_to_gl(self.camera_transform))
-        glMultMatrixf(trimesh.rendering.matrix_to_gl(self.view_transform))
+        glLoadMatrixf(self._modelview_gl)
 
     def unset_state(self):
         glPopMatrix()
@@ -84,15 +510,38 @@ class SceneGroup(pyglet.graphics.Group):
 
         glMatrixMode(GL_PROJECTION)
         glPopMatrix()
-        glMatrixMode(self._mode.value)
-        glViewport(
-            self._viewport[0],
-            self._viewport[1],
-            self._viewport[2],
-            self._viewport[3],
-        )
-
-        glPopAttrib()
+        # pyglet keeps GL_MODELVIEW current between draws
+        glMatrixMode(GL_MODELVIEW)
+        if self.viewport is not None:
+            glViewport(*self.viewport)
+
+        for cap in self._disabled_capabilities:
+            glDisable(cap)
+        if self._scissor_parent is not None:
+            rect = self._scissor_parent.rect
+            glScissor(
+                int(rect.left),
+                int(rect.bottom),
+                int(rect.width),
+                int(rect.height),
+            )
+        gl_state_cache['texture'] = None
+
+    def _compile_state_list(self):
+        # The enables and constant parameters of the scene are compiled into
+        # a display list, so the driver replays them from a single glCallList
+        # per frame.  The list is shared by every scene, and lives as long as
+        # the GL context.
+        state_list = glGenLists(1)
+        glNewList(state_list, GL_COMPILE)
+        glClearColor(*[.99, .99, .99, 1.0])
+        self._enable_depth()
+        self._enable_color_material()
+        self._enable_blending()
+        self._enable_smooth_lines()
+        self._enable_lighting()
+        glEndList()
+        return state_list
 
     def _enable_depth(self):
         glEnable(GL_DEPTH_TEST)
@@ -108,10 +557,9 @@ class SceneGroup(pyglet.graphics.Group):
         glColorMaterial(GL_FRONT_AND_BACK, GL_AMBIENT_AND_DIFFUSE)
         glShadeModel(GL_SMOOTH)
 
-        v = trimesh.rendering.vector_to_gl
-        glMaterialfv(GL_FRONT, GL_AMBIENT, v(0.192250, 0.192250, 0.192250))
-        glMaterialfv(GL_FRONT, GL_DIFFUSE, v(0.507540, 0.507540, 0.507540))
-        glMaterialfv(GL_FRONT, GL_SPECULAR, v(0.5082730, .5082730, .5082730))
+        glMaterialfv(GL_FRONT, GL_AMBIENT, MATERIAL_AMBIENT)
+        glMaterialfv(GL_FRONT, GL_DIFFUSE, MATERIAL_DIFFUSE)
+        glMaterialfv(GL_FRONT, GL_SPECULAR, MATERIAL_SPECULAR)
         glMaterialf(GL_FRONT, GL_SHININESS, 0.4 * 128.0)
 
     def _enable_blending(self):
@@ -128,50 +576,98 @@ class SceneGroup(pyglet.graphics.Group):
     def _enable_lighting(self):
         glEnable(GL_LIGHTING)
         glEnable(GL_LIGHT0)
+        # byte normals are only roughly unit length, and are rescaled by the
+        # dequantization in SceneGroup.model_transform
+        glEnable(GL_NORMALIZE)
 
-        v = trimesh.rendering.vector_to_gl
-        glLightfv(GL_LIGHT0, GL_AMBIENT, v(0.5, 0.5, 0.5, 1.0))
-        glLightfv(GL_LIGHT0, GL_DIFFUSE, v(1.0, 1.0, 1.0, 1.0))
-        glLightfv(GL_LIGHT0, GL_SPECULAR, v(1.0, 1.0, 1.0, 1.0))
-        glLightfv(GL_LIGHT0, GL_POSITION, v(0.0, 0.0, 0.0, 1.0))
+        glLightfv(GL_LIGHT0, GL_AMBIENT, LIGHT_AMBIENT)
+        glLightfv(GL_LIGHT0, GL_DIFFUSE, LIGHT_DIFFUSE)
+        glLightfv(GL_LIGHT0, GL_SPECULAR, LIGHT_SPECULAR)
+        glLightfv(GL_LIGHT0, GL_POSITION, LIGHT_POSITION)
 
     def _clear_buffers(self):
+        # The color has to be cleared on every frame as well as the depth:
+        # glooey clears the whole window to black before drawing, and the
+        # back buffer is undefined after a swap anyway.
         glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
 
 
 class MeshGroup(pyglet.graphics.Group):
 
-    def __init__(self, transform=None, texture=None, parent=None):
+    # Vertices are uploaded in world coords, so all meshes sharing a texture
+    # (or none) can use a single group and be drawn without matrix changes.
+
+    __slots__ = ('texture',)
+
+    def __init__(self, texture=None, parent=None):
         super().__init__(parent)
-        if transform is None:
-            transform = np.eye(4)
-        self.transform = transform
         self.texture = texture
 
     def set_state(self):
-        glPushMatrix()
-        glMultMatrixf(trimesh.rendering.matrix_to_gl(self.transform))
-
         if self.texture:
             glEnable(self.texture.target)
-            glBindTexture(self.texture.target, self.texture.id)
+            if gl_state_cache.get('texture') != self.texture.id:
+                glBindTexture(self.texture.target, self.texture.id)
+                gl_state_cache['texture'] = self.texture.id
 
     def unset_state(self):
         if self.texture:
             glDisable(self.texture.target)
 
-        glPopMatrix()
-
 
 class SceneWidget(glooey.Widget):
 
+    __slots__ = (
+        'scene',
+        'scene_group',
+        'vertex_list',
+        'index_ranges',
+        '_indices',
+        '_culled',
+        '_node_bounds',
+        'textures',
+        '_texture_bin',
+        '_texture_regions',
+        'mesh_groups',
+        '_vertexlists',
+        '_model_transform',
+        '_pixel_per_point',
+        '_viewport',
+        '__trackball',
+        '__camera_transform',
+        '__camera_pose',
+        '_redraw_pending',
+    )
+
     def __init__(self, scene):
         super().__init__()
         self.scene = scene
         self.scene_group = None
-        self.vertex_list = {}  # key: geometry_name, value: vertex_list
-        self.textures = {}     # key: geometry_name, value: vertex_list
+        # key: (texture, formats), value: vertex_list merged from all nodes
+        # sharing the texture and vertex format
+        self.vertex_list = {}
+        # key: node_name, value: (vertex_list key, index_offset, index_count)
+        self.index_ranges = {}
+        # key: vertex_list key, value: indices of vertex_list relative to its
+        # first vertex, with every mesh visible
+        self._indices = {}
+        self._culled = frozenset()  # node_names collapsed in the index buffers
+        self._node_bounds = {}  # key: node_name, value: (2, 3) world bounds
+        # key: geometry_name, value: texture region in an atlas of _texture_bin
+        self.textures = {}
+        self._texture_bin = None  # pyglet.image.atlas.TextureBin
+        self._texture_regions = {}  # key: id(image), value: texture region
+        self.mesh_groups = {}  # key: texture, value: mesh_group
+        # key: node_name, value: packed vertexlist, see pack_vertexlist
+        self._vertexlists = {}
+        self._model_transform = np.eye(4)
+        # window framebuffer pixels per point, and its whole viewport
+        self._pixel_per_point = (1, 1)
+        self._viewport = None
         self.__trackball = None
+        self.__camera_transform = None
+        self.__camera_pose = None
+        self._redraw_pending = False
 
     @property
     def _trackball(self):
@@ -184,30 +680,71 @@ class SceneWidget(glooey.Widget):
             )
         return self.__trackball
 
+    @property
+    def _camera_transform(self):
+        # inverse of the camera pose, only recomputed when the camera moves
+        camera_pose = self.scene.camera.transform
+        if self.__camera_pose is None or \
+                not np.array_equal(camera_pose, self.__camera_pose):
+            self.__camera_pose = np.array(camera_pose)
+            self.__camera_transform = np.linalg.inv(camera_pose)
+        return self.__camera_transform
+
     def do_claim(self):
         return 0, 0
 
+    def do_attach(self):
+        # The viewport restored after drawing the scene has to follow the
+        # window, which may be resized without resizing this widget.
+        self.window.push_handlers(on_resize=self._on_window_resize)
+
+    def do_detach(self):
+        self.window.remove_handlers(on_resize=self._on_window_resize)
+
+    def do_resize(self):
+        # may be called after the widget was undrawn and detached
+        if self.scene_group and self.is_attached_to_gui:
+            self._update_window_viewport()
+            self.scene_group.rect = self.rect
+
+    def _on_window_resize(self, width, height):
+        if self.scene_group:
+            self._update_window_viewport()
+
+    def _update_window_viewport(self):
+        viewport_size = self.window.get_viewport_size()
+        self._pixel_per_point = tuple(
+            np.array(viewport_size) / np.array(self.window.get_size())
+        )
+        self._viewport = (0, 0) + tuple(int(x) for x in viewport_size)
+        if self.scene_group:
+            self.scene_group.viewport = self._viewport
+            self.scene_group.pixel_per_point = self._pixel_per_point
+
     def do_regroup(self):
         if not self.vertex_list:
             return
+        # The rect and view are kept up to date on scene_group, so it only
+        # has to be rebuilt when it needs a new parent.
+        if self.scene_group.parent == self.group:
+            return
 
         self.scene_group = SceneGroup(
             rect=self.rect,
             camera_fovy=self.scene.camera.fov[1],
-            camera_transform=np.linalg.inv(self.scene.camera.transform),
-            view_transform=self._trackball.pose.copy(),
+            camera_transform=self._camera_transform,
+            view_transform=self._trackball.pose,
+            model_transform=self._model_transform,
             parent=self.group,
+            pixel_per_point=self._pixel_per_point,
+            viewport=self._viewport,
         )
-        for geometry_name, vertex_list in self.vertex_list.items():
-            mesh_group = MeshGroup(
-                transform=transform,
-                texture=self.textures.get(geometry_name),
-                parent=self.scene_group,
-            )
+        self.mesh_groups = {}
+        for (texture, _), vertex_list in self.vertex_list.items():
             self.batch.migrate(
                 vertex_list,
                 GL_TRIANGLES,
-                mesh_group,
+                self._get_mesh_group(texture),
                 self.batch,
             )
 
@@ -215,40 +752,58 @@ class SceneWidget(glooey.Widget):
         # Because the vertex list can't change, we don't need to do anything if
         # the vertex list is already set.
         if self.vertex_list:
+            self._update_culling()
             return
 
-        pixel_per_point = np.array(self.window.get_viewport_size()) / \
-            np.array(self.window.get_size()),
+        # built from the scene as it is when first drawn, and again after
+        # every undraw, so later changes to the scene are picked up
+        if not self._vertexlists:
+            self._preprocess_scene()
+
+        self._update_window_viewport()
         self.scene_group = SceneGroup(
             rect=self.rect,
             camera_fovy=self.scene.camera.fov[1],
-            camera_transform=np.linalg.inv(self.scene.camera.transform),
-            view_transform=self._trackball.pose.copy(),
+            camera_transform=self._camera_transform,
+            view_transform=self._trackball.pose,
+            model_transform=self._model_transform,
             parent=self.group,
-            pixel_per_point=pixel_per_point,
+            pixel_per_point=self._pixel_per_point,
+            viewport=self._viewport,
         )
 
-        node_names = self.scene.graph.nodes_geometry
-        for node_name in node_names:
-            transform, geometry_name = self.scene.graph[node_name]
+        # key: (texture, formats), value: [(node_name, packed vertexlist)]
+        vertexlists = collections.defaultdict(list)
+        for node_name, vertexlist in self._vertexlists.items():
+            _, geometry_name = self.scene.graph[node_name]
             geometry = self.scene.geometry[geometry_name]
-            assert isinstance(geometry, trimesh.Trimesh)
 
-            if hasattr(geometry, 'visual') and \
+            if geometry_name not in self.textures and \
+                    hasattr(geometry, 'visual') and \
                     hasattr(geometry.visual, 'material'):
                 self.textures[geometry_name] = \
-                    trimesh.rendering.material_to_texture(
-                        geometry.visual.material)
-
-            mesh_group = MeshGroup(
-                transform=transform,
-                texture=self.textures.get(geometry_name),
-                parent=self.scene_group,
+                    self._add_texture(geometry.visual.material)
+
+            # regions of one atlas share its texture, and so a mesh_group
+            region = self.textures.get(geometry_name)
+            texture = None
+            if region is not None:
+                texture = getattr(region, 'owner', region)
+                vertexlist = atlas_tex_coords(vertexlist, region)
+            formats = tuple(format for format, _ in vertexlist[2])
+            vertexlists[texture, formats].append((node_name, vertexlist))
+
+        for key, items in vertexlists.items():
+            names, node_vertexlists = zip(*items)
+            vertexlist, ranges = merge_vertexlists(node_vertexlists)
+            self.vertex_list[key] = self._add_vertexlist(
+                vertexlist, self._get_mesh_group(key[0])
             )
-            args = trimesh.rendering.mesh_to_vertexlist(
-                geometry, group=mesh_group
-            )
-            self.vertex_list[geometry_name] = self.batch.add_indexed(*args)
+            self._indices[key] = vertexlist[1]
+            for node_name, (index_offset, index_count) in zip(names, ranges):
+                self.index_ranges[node_name] = (key, index_offset, index_count)
+        self._culled = frozenset()
+        self._update_culling()
 
     def do_undraw(self):
         if not self.vertex_list:
@@ -256,7 +811,155 @@ class SceneWidget(glooey.Widget):
         for vertex_list in self.vertex_list.values():
             vertex_list.delete()
         self.vertex_list = {}
+        self.index_ranges = {}
+        self._indices = {}
+        self._culled = frozenset()
         self.textures = {}
+        self._texture_bin = None
+        self._texture_regions = {}
+        self.mesh_groups = {}
+        self._vertexlists = {}
+        self._node_bounds = {}
+        self._model_transform = np.eye(4)
+
+    def _add_texture(self, material):
+        # Pack material images into shared atlases, so textured meshes can be
+        # merged and drawn with one glBindTexture.
+        image = getattr(material, 'image', None)
+        if image is None:
+            image = getattr(material, 'baseColorTexture', None)
+        if image is None:
+            return None
+        if id(image) in self._texture_regions:
+            return self._texture_regions[id(image)]
+
+        with io.BytesIO() as f:
+            image.save(f, format='png')
+            f.seek(0)
+            image_data = pyglet.image.load(filename='.png', file=f)
+
+        if self._texture_bin is None:
+            self._texture_bin = pyglet.image.atlas.TextureBin()
+        try:
+            region = self._texture_bin.add(image_data)
+        except pyglet.image.atlas.AllocatorException:
+            # larger than an atlas, so it gets a texture of its own
+            region = image_data.get_texture()
+        self._texture_regions[id(image)] = region
+        return region
+
+    def _get_mesh_group(self, texture):
+        if texture not in self.mesh_groups:
+            self.mesh_groups[texture] = MeshGroup(
+                texture=texture,
+                parent=self.scene_group,
+            )
+        return self.mesh_groups[texture]
+
+    def _add_vertexlist(self, vertexlist, group):
+        # pyglet interleaves all static attributes into one buffer, so the
+        # packed bytes can't be copied straight into the attribute regions.
+        # Hand them over as arrays of the format's type instead, and let
+        # pyglet scatter them into the interleaved layout.
+        count, indices, attributes = vertexlist
+        return self.batch.add_indexed(
+            count,
+            GL_TRIANGLES,
+            group,
+            indices.tolist(),
+            *[
+                (format, np.frombuffer(
+                    data, dtype=_GL_DTYPES[format.partition('/')[0][-1]]
+                ))
+                for format, data in attributes
+            ]
+        )
+
+    def _update_culling(self):
+        # Meshes are merged into a few vertex lists, so meshes outside of the
+        # view frustum can't be skipped draw call by draw call.  Instead their
+        # triangles are collapsed onto a single vertex, which the GPU discards
+        # before rasterization, and the index buffers are only rewritten when
+        # the set of culled meshes changes.
+        if not self.index_ranges:
+            return
+
+        group = self.scene_group
+        world_to_clip = (
+            group.projection_transform @
+            group.camera_transform @ group.view_transform
+        )
+        names = list(self.index_ranges)
+        visible = bounds_in_frustum(
+            [self._node_bounds[node_name] for node_name in names],
+            frustum_planes(world_to_clip),
+        )
+        culled = frozenset(
+            node_name for node_name, v in zip(names, visible) if not v
+        )
+        if culled == self._culled:
+            return
+        keys = {self.index_ranges[n][0] for n in culled ^ self._culled}
+        self._culled = culled
+
+        indices = {key: self._indices[key].copy() for key in keys}
+        for node_name in culled:
+            key, offset, count = self.index_ranges[node_name]
+            if key in indices and count:
+                indices[key][offset:offset + count] = \
+                    indices[key][offset]
+        for key, key_indices in indices.items():
+            vertex_list = self.vertex_list[key]
+            data = (key_indices + vertex_list.start).astype(np.uint32)
+            ctypes.memmove(vertex_list.indices, data.tobytes(), data.nbytes)
+
+    def _preprocess_scene(self):
+        # Do all the per-vertex work up front, leaving the rest of do_draw to
+        # create textures and copy bytes into GL buffers.
+        geometry_vertexlists = {}  # key: geometry_name, value: vertexlist
+        vertexlists = {}
+        for node_name in self.scene.graph.nodes_geometry:
+            transform, geometry_name = self.scene.graph[node_name]
+            if geometry_name not in geometry_vertexlists:
+                geometry_vertexlists[geometry_name] = \
+                    self._geometry_to_vertexlist(geometry_name)
+            # nodes without faces draw nothing and have no bounds, so they
+            # are left out of the packed, merged and culled meshes
+            if not len(geometry_vertexlists[geometry_name][3]):
+                continue
+            # The node transform is applied to the vertices here, so it
+            # doesn't need to be multiplied onto the matrix stack every frame.
+            vertexlists[node_name] = transform_vertexlist(
+                geometry_vertexlists[geometry_name], transform
+            )
+            self._node_bounds[node_name] = \
+                vertexlist_bounds([vertexlists[node_name]])
+        if not vertexlists:
+            return
+
+        # quantize all meshes against the scene bounds, so the whole scene
+        # is restored by the model transform of scene_group
+        center, scale = quantization = bounds_to_quantization(
+            vertexlist_bounds(list(vertexlists.values()))
+        )
+        self._model_transform = \
+            tf.translation_matrix(center) @ tf.scale_matrix(scale)
+        for node_name, args in vertexlists.items():
+            args = quantize_vertexlist(args, quantization)
+            self._vertexlists[node_name] = pack_vertexlist(args)
+
+    def _geometry_to_vertexlist(self, geometry_name):
+        geometry = self.scene.geometry[geometry_name]
+        assert isinstance(geometry, trimesh.Trimesh)
+
+        if hasattr(geometry.visual, 'uv'):
+            # Textured vertices are uploaded as-is, so drop duplicates that
+            # share position and UV.  Untextured meshes don't need this as
+            # mesh_to_vertexlist re-merges them when smoothing.
+            geometry = geometry.copy()
+            geometry.merge_vertices()
+        args = trimesh.rendering.mesh_to_vertexlist(geometry)
+        return optimize_vertexlist(args)
 
     def on_mouse_press(self, x, y, buttons, modifiers):
         self._trackball.set_state(Trackball.STATE_ROTATE)
@@ -274,30 +977,52 @@ class SceneWidget(glooey.Widget):
         elif (buttons == pyglet.window.mouse.RIGHT):
             self._trackball.set_state(Trackball.STATE_ZOOM)
 
-        self._trackball.down(np.array([x, y]))
-        if self.scene_group:
-            self.scene_group.view_transform = self._trackball.pose.copy()
-        self._draw()
+        self._trackball.down((x, y))
+        self._update_view()
 
     def on_mouse_drag(self, x, y, dx, dy, buttons, modifiers):
+        if dx == 0 and dy == 0:
+            return
+        mouse = pyglet.window.mouse
+        if not buttons & (mouse.LEFT | mouse.MIDDLE | mouse.RIGHT):
+            return
+
         # detect crossing edge between widgets
         x_prev = x - dx
         y_prev = y - dy
-        left, bottom = self.rect.left, self.rect.bottom
-        width, height = self.rect.width, self.rect.height
-        if not (left <= x_prev <= left + width) or \
-                not (bottom <= y_prev <= bottom + height):
-            self._trackball.down(np.array([x, y]))
+        rect = self.rect
+        left, bottom = rect.left, rect.bottom
+        right, top = left + rect.width, bottom + rect.height
+        # bitwise or evaluates all four tests without short-circuit branches
+        if (x_prev < left) | (x_prev > right) | \
+                (y_prev < bottom) | (y_prev > top):
+            self._trackball.down((x, y))
 
-        self._trackball.drag(np.array([x, y]))
-        if self.scene_group:
-            self.scene_group.view_transform = self._trackball.pose.copy()
-        self._draw()
+        self._trackball.drag((x, y))
+        self._update_view()
 
     def on_mouse_scroll(self, x, y, dx, dy):
         self._trackball.scroll(dy)
+        self._update_view()
+
+    def _update_view(self):
+        # only redraw if the trackball actually moved the view
+        pose = self._trackball.pose
         if self.scene_group:
-            self.scene_group.view_transform = self._trackball.pose.copy()
+            if np.array_equal(pose, self.scene_group.view_transform):
+                return
+            self.scene_group.view_transform = pose
+        self._request_redraw()
+
+    def _request_redraw(self):
+        # Mouse events can arrive many times per frame, so coalesce them into
+        # a single redraw on the next clock tick.
+        if not self._redraw_pending:
+            self._redraw_pending = True
+            pyglet.clock.schedule_once(self._redraw, 0)
+
+    def _redraw(self, dt):
+        self._redraw_pending = False
         self._draw()
 
 